@@ -6,16 +6,45 @@ Date: 2018-11-22
 
 """
 
-import argparse
 import os
+
+if os.environ.get('CMDBTOOLS_GEVENT') == '1':
+    # Opt-in: run the concurrent queries of `annotate` on gevent greenlets.
+    # Patching must happen before `socket`, `ssl` and `threading` are imported.
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pool import Pool as GreenletPool
+else:
+    GreenletPool = None
+
+import argparse
+import base64
 import sys
 import gzip
+import heapq
+import io
 import json
-import yaml
+import socket
+import threading
+import time
 
+from collections import OrderedDict
 from datetime import datetime
-from urllib import urlencode
-from urllib2 import Request, urlopen, HTTPError
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial, wraps
+from itertools import izip
+from multiprocessing.pool import ApplyResult, ThreadPool
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from urllib import getproxies, proxy_bypass, unquote, urlencode
+from urllib2 import HTTPError
+from urlparse import urljoin, urlsplit
+
+try:
+    # ujson decodes API responses several times faster than the stdlib
+    import ujson
+    json_loads = partial(ujson.loads, precise_float=True)
+except ImportError:
+    json_loads = json.loads
 
 if sys.version_info.major != 2:
     raise Exception('This tool supports only python2')
@@ -37,6 +66,8 @@ annotate_command = commands.add_parser('annotate', help='Annotate input VCF.',
                                                    'split into multiple bi-allelic variant records.')
 annotate_command.add_argument('-i', '--vcffile', metavar='VCF_FILE', type=str, required=True, dest='in_vcffile',
                               help='input VCF file.')
+annotate_command.add_argument('-t', '--threads', metavar='INT', type=int, dest='threads', default=50,
+                              help='Number of concurrent queries to CMDB API. [50]')
 
 query_variant_command = commands.add_parser('query-variant',
                                             help='Query variant by variant identifier or by chromosome name and '
@@ -60,11 +91,37 @@ query_variant_command.add_argument('-l', '--positions', metavar='File-contain-a-
 
 USER_HOME = os.path.expanduser("~")
 CMDB_DIR = '.cmdb'
-CMDB_TOKENSTORE = 'authaccess.yaml'
+CMDB_TOKENSTORE = 'authaccess.json'
+CMDB_TOKENSTORE_PATH = os.path.join(USER_HOME, CMDB_DIR, CMDB_TOKENSTORE)
+# YAML token store written by cmdbtools <= 1.0.6.2, it's converted to JSON on first use
+CMDB_LEGACY_TOKENSTORE_PATH = os.path.join(USER_HOME, CMDB_DIR, 'authaccess.yaml')
 
 CMDB_DATASET_VERSION = 'CMDB_hg19_v1.0'
 CMDB_API_VERSION = 'v1.0'
 
+# INFO keys added by `annotate`, in sorted order
+CMDB_INFO_KEYS = ('CMDB_AC', 'CMDB_AF', 'CMDB_AN', 'CMDB_FILTER')
+
+# Number of VCF records to be queried concurrently in one batch by `annotate`
+ANNOTATE_BATCH_SIZE = 1000
+# Max number of (chromosome, position) query results kept in memory
+QUERY_CACHE_SIZE = 100000
+
+# Size in bytes of the blocks read from input VCF and of the output buffer of annotated VCF
+READ_BUFFER_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Timeout in seconds of a single HTTP request to CMDB API
+HTTP_TIMEOUT = 30
+HTTP_MAX_REDIRECTS = 5
+# Failed requests are retried up to HTTP_RETRIES times, waiting
+# HTTP_RETRY_BACKOFF * 2^(retry-1) seconds before each retry but the first,
+# or as long as the server asks by Retry-After (at most HTTP_RETRY_AFTER_MAX)
+HTTP_RETRIES = 5
+HTTP_RETRY_BACKOFF = 0.3
+HTTP_RETRY_AFTER_MAX = 60
+HTTP_RETRY_STATUS = (429, 502, 503, 504)
+
 CMDB_VCF_HEADER = [
     '##fileformat=VCFv4.2',
     '##FILTER=<ID=LowQual,Description="Low quality">',
@@ -86,6 +143,35 @@ class CMDBException(Exception):
         return self.message
 
 
+def lru_cache(maxsize=128):
+    """A thread-safe least-recently-used memoizer for functions with hashable
+    positional arguments, `functools.lru_cache` is not available in python2.
+    """
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            with lock:
+                if args in cache:
+                    result = cache.pop(args)
+                    cache[args] = result  # move to the most recently used end
+                    return result
+
+            result = func(*args)
+            with lock:
+                cache[args] = result
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 def load_version():
     if not authaccess_exists():
         print "No access tokens found. Please login first.\n"
@@ -97,39 +183,188 @@ def load_version():
 
 class Requests(object):
     # this implements the parts we need of the real `Requests` module
+
+    # Connections are kept alive and shared by all workers through a free list,
+    # so repeated queries to CMDB API don't pay for a new TCP/TLS handshake every time.
+    _idle_connections = {}
+    _lock = threading.Lock()
+
+    # (proxy netloc, proxy headers) or None of every (scheme, netloc), resolved once
+    _proxies = {}
+
     @staticmethod
     def get(url, headers={'User-Agent': 'Mozilla/5.0'}, params=None):
         if params:
             url += '?' + urlencode(params)
 
-        r = Request(url=url, headers=headers)
-        try:
-            response = urlopen(r)
-        except HTTPError:
-            response = None
+        status_code, content = Requests._request('GET', url, headers)
+        if status_code == 404:
+            return _RequestsResponse(404, None)
 
-        return _RequestsResponse(response)
+        # Any other error must not be taken (and cached) as a missing variant
+        if status_code >= 400:
+            raise HTTPError(url, status_code, 'Failed to get data.', None, None)
+
+        return _RequestsResponse(status_code, content)
 
     @staticmethod
     def post(url, headers={'User-Agent': 'Mozilla/5.0'}, data=None):
         if data is not None and isinstance(data, dict):
             data = urlencode(data)
+            headers = dict(headers, **{'Content-Type': 'application/x-www-form-urlencoded'})
 
-        r = Request(url, headers=headers, data=data)
-        return _RequestsResponse(urlopen(r))
+        status_code, content = Requests._request('POST', url, headers, data)
+        if status_code >= 400:
+            raise HTTPError(url, status_code, 'Failed to post data.', None, None)
 
+        return _RequestsResponse(status_code, content)
 
-class _RequestsResponse(object):
-    def __init__(self, response):
+    @staticmethod
+    def _acquire(key, fresh=False):
+        # A `fresh` connection is never taken from the idle ones, which may be stale too.
+        if not fresh:
+            with Requests._lock:
+                idle = Requests._idle_connections.get(key)
+                if idle:
+                    return idle.pop()
+
+        scheme, netloc = key
+        proxy = Requests._proxy(key)
+        if scheme == 'https':
+            if proxy is None:
+                return HTTPSConnection(netloc, timeout=HTTP_TIMEOUT)
+
+            # HTTPS goes through a CONNECT tunnel of the proxy
+            proxy_netloc, proxy_headers = proxy
+            connection = HTTPSConnection(proxy_netloc, timeout=HTTP_TIMEOUT)
+            connection.set_tunnel(netloc, headers=proxy_headers)
+            return connection
+
+        return HTTPConnection(proxy[0] if proxy else netloc, timeout=HTTP_TIMEOUT)
+
+    @staticmethod
+    def _proxy(key):
+        # Like `urlopen`, honour http_proxy, https_proxy and no_proxy of the environment.
+        if key not in Requests._proxies:
+            scheme, netloc = key
+            proxy = getproxies().get(scheme)
+            if not proxy or proxy_bypass(netloc):
+                Requests._proxies[key] = None
+            else:
+                if '://' not in proxy:
+                    proxy = 'http://' + proxy
+
+                p = urlsplit(proxy)
+                proxy_headers = {}
+                if p.username is not None:
+                    credentials = '{}:{}'.format(unquote(p.username), unquote(p.password or ''))
+                    proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+
+                Requests._proxies[key] = (p.netloc.rpartition('@')[2], proxy_headers)
+
+        return Requests._proxies[key]
 
-        if response:
-            self.status_code = response.getcode()
-            self._json = json.load(response.fp)
+    @staticmethod
+    def _release(key, connection):
+        with Requests._lock:
+            Requests._idle_connections.setdefault(key, []).append(connection)
+
+    @staticmethod
+    def _request(method, url, headers, body=None):
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            u = urlsplit(url)
+            path = '{}?{}'.format(u.path or '/', u.query) if u.query else (u.path or '/')
+
+            response, content = Requests._send((u.scheme, u.netloc), method, path, headers, body)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+
+            return response.status, content
+
+        raise HTTPError(url, response.status, 'Too many redirects.', None, None)
+
+    @staticmethod
+    def _send(key, method, path, headers, body):
+        # Connection errors (including a kept-alive connection dropped by the
+        # server), rate limiting and temporary server errors are retried with backoff.
+        scheme, netloc = key
+        url = '{}://{}{}'.format(scheme, netloc, path)
+        proxy = Requests._proxy(key)
+        if proxy is not None and scheme == 'http':
+            # Plain HTTP is sent to the proxy with the absolute URL
+            path = url
+            headers = dict(headers, **proxy[1])
+
+        fresh, retry_after = False, None
+        for retry in range(HTTP_RETRIES + 1):
+            if retry_after is not None:
+                time.sleep(retry_after)
+            elif retry > 1:
+                time.sleep(HTTP_RETRY_BACKOFF * (2 ** (retry - 1)))
+
+            connection = Requests._acquire(key, fresh)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+
+                # The whole body must be read before the connection can be reused.
+                content = response.read()
+            except (HTTPException, socket.error):
+                connection.close()
+                if retry == HTTP_RETRIES:
+                    raise
+
+                fresh, retry_after = True, None
+                continue
+
+            Requests._release(key, connection)
+            if response.status not in HTTP_RETRY_STATUS:
+                return response, content
+
+            fresh, retry_after = False, Requests._retry_after(response)
+
+        # Don't let a server which is still unavailable look like a missing variant.
+        raise HTTPError(url, response.status,
+                        'CMDB API is unavailable after {} retries.'.format(HTTP_RETRIES), None, None)
+
+    @staticmethod
+    def _retry_after(response):
+        # Retry-After is either a number of seconds or an HTTP date
+        value = response.getheader('Retry-After')
+        if not value:
+            return None
+
+        value = value.strip()
+        if value.isdigit():
+            seconds = int(value)
         else:
-            self.status_code = 404
-            self._json = None
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+
+            seconds = mktime_tz(date) - time.time()
+
+        return min(max(seconds, 0), HTTP_RETRY_AFTER_MAX)
+
+
+class _RequestsResponse(object):
+    def __init__(self, status_code, content):
+
+        self.status_code = status_code
+        self._content = content
+        self._json = None
 
     def json(self):
+        # The body is decoded on first use, callers which only check
+        # `status_code` (e.g. `login`) never pay for parsing it.
+        if self._content is not None:
+            self._json = json_loads(self._content)
+            self._content = None
+
         return self._json
 
 
@@ -141,8 +376,14 @@ Requests.exceptions = _RequestsExceptions
 Requests.exceptions.RequestException = HTTPError
 
 
+# Token store loaded by `read_tokenstore`, it's read from disk only once per process
+_TOKENSTORE = None
+
+
 def authaccess_exists():
-    return os.path.isfile(os.path.join(USER_HOME, CMDB_DIR, CMDB_TOKENSTORE))
+    # No need to stat the token store again once it has been loaded
+    return (_TOKENSTORE is not None or os.path.isfile(CMDB_TOKENSTORE_PATH) or
+            os.path.isfile(CMDB_LEGACY_TOKENSTORE_PATH))
 
 
 def create_tokenstore():
@@ -150,7 +391,7 @@ def create_tokenstore():
     if not os.path.isdir(p):
         os.mkdir(p, 0700)
 
-    p = os.path.join(p, CMDB_TOKENSTORE)
+    p = CMDB_TOKENSTORE_PATH
     if not os.path.isfile(p):
         # create file
         open(p, 'a').close()
@@ -158,36 +399,76 @@ def create_tokenstore():
 
 
 def read_tokenstore():
-    token_path = os.path.join(USER_HOME, CMDB_DIR, CMDB_TOKENSTORE)
-    with open(token_path, 'r') as I:
-        tokenstore = yaml.load(I)
+    global _TOKENSTORE
+    if _TOKENSTORE is not None:
+        return _TOKENSTORE
+
+    if not os.path.isfile(CMDB_TOKENSTORE_PATH) and os.path.isfile(CMDB_LEGACY_TOKENSTORE_PATH):
+        migrate_legacy_tokenstore()
+
+    with open(CMDB_TOKENSTORE_PATH, 'r') as I:
+        try:
+            tokenstore = json.load(I)
+        except ValueError:
+            tokenstore = {}
 
         access_token = tokenstore.get('access_token', None)
         if access_token is None or not isinstance(access_token, basestring):
             raise CMDBException('Invalid or outdated access token. You may need to run login.')
 
+        _TOKENSTORE = tokenstore
         return tokenstore
 
 
 def write_tokenstore(token, url):
-    file_path = os.path.join(USER_HOME, CMDB_DIR, CMDB_TOKENSTORE)
-    with open(file_path, 'w') as tokenstore:
-        token_obj = {
-            "url": "{}/api/{}".format(url, CMDB_API_VERSION),
-            "access_token": token,
-            "version": CMDB_DATASET_VERSION
-        }
-        yaml.dump(token_obj, tokenstore)
+    token_obj = {
+        "url": "{}/api/{}".format(url, CMDB_API_VERSION),
+        "access_token": token,
+        "version": CMDB_DATASET_VERSION
+    }
+    _dump_tokenstore(token_obj)
+
+
+def migrate_legacy_tokenstore():
+    # PyYAML is only needed to read the token store of older cmdbtools versions
+    try:
+        import yaml
+    except ImportError:
+        raise CMDBException('Found an access token from an older version of cmdbtools, '
+                            'please install PyYAML or run login again.')
+
+    with open(CMDB_LEGACY_TOKENSTORE_PATH, 'r') as I:
+        tokenstore = yaml.safe_load(I) or {}
 
-    os.chmod(file_path, 0600)
+    create_tokenstore()
+    _dump_tokenstore(tokenstore)
+
+
+def _dump_tokenstore(token_obj):
+    global _TOKENSTORE
+    with open(CMDB_TOKENSTORE_PATH, 'w') as tokenstore:
+        json.dump(token_obj, tokenstore)
+
+    os.chmod(CMDB_TOKENSTORE_PATH, 0600)
+    if os.path.isfile(CMDB_LEGACY_TOKENSTORE_PATH):
+        os.remove(CMDB_LEGACY_TOKENSTORE_PATH)
+
+    _TOKENSTORE = None
 
 
 def login(token, url):
     # Test the token is available or not
     test_url = "{}/api/v1.0/variant?token={}&type=position&query=chr17-41234470".format(url, token)
-    cmdb_response = Requests.get(test_url)
+    try:
+        cmdb_response = Requests.get(test_url)
+    except HTTPError as e:
+        # A rejected token, unlike an unavailable server, is reported below
+        if e.code >= 500:
+            raise
 
-    if cmdb_response.status_code != 201:
+        cmdb_response = None
+
+    if cmdb_response is None or cmdb_response.status_code != 201:
         raise CMDBException('Error while obtaining your token with CMDB API authentication server.'
                             'You may do not have the API access or the token is wrong.\n')
 
@@ -202,12 +483,16 @@ def login(token, url):
 
 def logout():
     # logout by delete the tokenstore file
+    global _TOKENSTORE
     if not authaccess_exists():
         sys.stderr.write("Don't find any your access token, no need to logout.\n")
         return
 
-    file_path = os.path.join(USER_HOME, CMDB_DIR, CMDB_TOKENSTORE)
-    os.remove(file_path)
+    for file_path in (CMDB_TOKENSTORE_PATH, CMDB_LEGACY_TOKENSTORE_PATH):
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+    _TOKENSTORE = None
     sys.stdout.write("Done.\nLogout successful.\n")
 
     return
@@ -271,88 +556,195 @@ def query_variant(chromosome, position):
     if chromosome is None or position is None:
         raise CMDBException('Provide both "-c,--chromosome" and "-p,--position".')
 
-    query_url = '{}/variant?&type=position&query={}-{}'.format(tokenstore["url"], chromosome, position)
-    return _query_nonpaged(tokenstore["access_token"], query_url)
+    return _query_position(tokenstore["url"], tokenstore["access_token"], chromosome, position)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _query_position(url, token, chromosome, position):
+    query_url = '{}/variant?&type=position&query={}-{}'.format(url, chromosome, position)
+    return _query_nonpaged(token, query_url)
+
+
+def read_lines(infile, buffer_size=READ_BUFFER_SIZE):
+    """Yield the lines of a plain or gzipped text file without the line breaks.
+
+    The file is read in blocks of `buffer_size` bytes, which is much faster
+    than iterating over a gzip file line by line.
+    """
+    with gzip.open(infile, 'rb') if infile.endswith('.gz') else open(infile, 'rb') as I:
+        remainder = ''
+        while True:
+            block = I.read(buffer_size)
+            if not block:
+                break
+
+            lines = (remainder + block).split('\n')
+            remainder = lines.pop()  # the last line may be continued in the next block
+            for line in lines:
+                yield line
+
+        if remainder:
+            yield remainder
+
+
+def _query_record(chrom_pos):
+    return query_variant(*chrom_pos)
 
 
-def annotate(infile, filter=None):
+def rewrite_vcf_record(in_fields, cmdb_variant):
+    """Return the VCF line of `in_fields` with the INFO of `cmdb_variant` merged in.
+
+    `in_fields` are the columns of one VCF record and `cmdb_variant` is the
+    result of `query_variant` for its position, the record is returned as it
+    is if CMDB has no matched variant.
+    """
+    chromosome = in_fields[0]
+    position = int(in_fields[1])
+    ref = in_fields[3]
+    alt = in_fields[4]  # assume bi-allelic
+
+    # Must just be one element in the `list`
+    if cmdb_variant:
+        cmdb_variant = cmdb_variant[0]
+
+    # ignore `chr` in `variant` which could be compared with variant-id in CMDB
+    variants = ['-'.join([chromosome.split('chr')[-1], str(position), ref, a]).upper()
+                for a in alt.split(',')]
+
+    if cmdb_variant is None or (cmdb_variant and (cmdb_variant['variant_id'] not in variants)):
+        return '\t'.join(in_fields) + '\n'
+
+    else:
+        # CMDB_INFO_KEYS are already in sorted order.
+        cmdb_items = [
+            ('CMDB_AC', 'CMDB_AC={}'.format(cmdb_variant['allele_count'])),
+            ('CMDB_AF', 'CMDB_AF={}'.format(cmdb_variant['allele_freq'])),
+            ('CMDB_AN', 'CMDB_AN={}'.format(cmdb_variant['allele_num'])),
+            ('CMDB_FILTER', 'CMDB_FILTER={}'.format(cmdb_variant['filter_status']))
+        ]
+
+        info_items = []
+        info = in_fields[7]
+        if info != '.':
+            seen_keys = set(CMDB_INFO_KEYS)
+            for c in info.split(';'):
+                k = c.split('=', 1)[0]
+                if k not in seen_keys:
+                    seen_keys.add(k)
+                    info_items.append((k, c))
+
+            # The original INFO is usually sorted already, only sort it when it isn't.
+            if any(info_items[i][0] > info_items[i + 1][0] for i in xrange(len(info_items) - 1)):
+                info_items.sort()
+
+        # Both lists are sorted by key, merging them keeps the INFO field in sorted order.
+        out_fields = list(in_fields)
+        out_fields[7] = ';'.join([c for _, c in heapq.merge(cmdb_items, info_items)])
+        return '\t'.join(out_fields) + '\n'
+
+
+def _query_batch(pool, batch):
+    keys = [(in_fields[0], int(in_fields[1])) for in_fields in batch]
+
+    # Records sharing one position (e.g. split multi-allelic sites) are queried only once
+    positions = list(OrderedDict.fromkeys(keys))
+    return batch, keys, positions, pool.map_async(_query_record, positions)
+
+
+def _write_batch(out, queried_batch):
+    batch, keys, positions, async_result = queried_batch
+
+    # A blocking `get()` of ThreadPool can't be interrupted by Ctrl-C in python2
+    if isinstance(async_result, ApplyResult):
+        while not async_result.ready():
+            async_result.wait(1)
+
+    cmdb_variants = dict(zip(positions, async_result.get()))
+
+    # The whole batch is rewritten at once and written out in a single call
+    out.write(''.join([rewrite_vcf_record(in_fields, cmdb_variants[key])
+                       for in_fields, key in izip(batch, keys)]))
+
+
+def annotate(infile, filter=None, threads=50):
     if not authaccess_exists():
         raise CMDBException('[ERROR] No access tokens found. Please login first.\n')
 
     data_version = load_version()
-    with gzip.open(infile) if infile.endswith('.gz') else open(infile) as I:
-
-        for in_line in I:
+    cmdb_header = ''.join([
+        '##INFO=<ID=CMDB_AN,Number=1,Type=Integer,Description="Number of Alleles in Samples with Coverage from {}">\n'.format(
+            data_version),
+        '##INFO=<ID=CMDB_AC,Number=A,Type=Integer,Description="Alternate Allele Counts in Samples with Coverage from {}">\n'.format(
+            data_version),
+        '##INFO=<ID=CMDB_AF,Number=A,Type=Float,Description="Alternate Allele Frequencies from {}">\n'.format(
+            data_version),
+        '##INFO=<ID=CMDB_FILTER,Number=A,Type=Float,Description="Filter from {}">\n'.format(
+            data_version)
+    ])
+
+    # Write the annotated VCF through a large binary buffer on stdout
+    sys.stdout.flush()
+    out = io.open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False)
+
+    pool = GreenletPool(max(1, threads)) if GreenletPool else ThreadPool(max(1, threads))
+    # Batches whose queries have been submitted but which aren't written out yet
+    batch, queried = [], []
+    interrupted = False
+    try:
+        for in_line in read_lines(infile):
 
             if in_line.startswith('#'):
                 if in_line.startswith('##'):
-                    sys.stdout.write('{}\n'.format(in_line.rstrip()))
+                    out.write(in_line.rstrip() + '\n')
 
                 elif in_line.startswith('#CHROM'):
-
-                    sys.stdout.write(
-                        '##INFO=<ID=CMDB_AN,Number=1,Type=Integer,Description="Number of Alleles in Samples with Coverage from {}">\n'.format(
-                            data_version))
-                    sys.stdout.write(
-                        '##INFO=<ID=CMDB_AC,Number=A,Type=Integer,Description="Alternate Allele Counts in Samples with Coverage from {}">\n'.format(
-                            data_version))
-                    sys.stdout.write(
-                        '##INFO=<ID=CMDB_AF,Number=A,Type=Float,Description="Alternate Allele Frequencies from {}">\n'.format(
-                            data_version))
-                    sys.stdout.write(
-                        '##INFO=<ID=CMDB_FILTER,Number=A,Type=Float,Description="Filter from {}">\n'.format(
-                            data_version))
-                    sys.stdout.write('{}\n'.format(in_line.rstrip()))
+                    out.write(cmdb_header)
+                    out.write(in_line.rstrip() + '\n')
 
                 continue
 
-            in_fields = in_line.rstrip().split()
+            # FORMAT and sample columns are kept as one field, they're never modified
+            in_fields = in_line.rstrip().split(None, 8)
             if 'chr' not in in_fields[0].lower():
                 in_fields[0] = 'chr' + in_fields[0].lower()
 
-            chromosome = in_fields[0]
-            position = int(in_fields[1])
-            ref = in_fields[3]
-            alt = in_fields[4]  # assume bi-allelic
+            batch.append(in_fields)
+            if len(batch) >= ANNOTATE_BATCH_SIZE:
+                # Start querying this batch first, so its queries run while
+                # the batch submitted before is written out.
+                queried.append(_query_batch(pool, batch))
+                batch = []
+                if len(queried) > 1:
+                    _write_batch(out, queried.pop(0))
+
+        if batch:
+            queried.append(_query_batch(pool, batch))
+
+        while queried:
+            _write_batch(out, queried.pop(0))
+
+    except KeyboardInterrupt:
+        interrupted = True
+        raise
+
+    finally:
+        # All the submitted queries are done unless annotating failed,
+        # then the workers are stopped before the error is raised.
+        if isinstance(pool, ThreadPool):
+            pool.terminate()
+        else:
+            # The greenlets of `map_async` are spawned outside of the pool
+            for _, _, _, async_result in queried:
+                async_result.kill()
 
-            cmdb_variant = query_variant(chromosome, position)
-            # Must just be one element in the `list`
-            if cmdb_variant:
-                cmdb_variant = cmdb_variant[0]
+            pool.kill()
 
-            # ignore `chr` in `variant` which could be compared with variant-id in CMDB
-            variants = ['-'.join([chromosome.split('chr')[-1], str(position), ref, a]).upper()
-                        for a in alt.split(',')]
+        # Don't wait for the queries in flight after Ctrl-C
+        if not interrupted:
+            pool.join()
 
-            if cmdb_variant is None or (cmdb_variant and (cmdb_variant['variant_id'] not in variants)):
-                sys.stdout.write('{}\n'.format('\t'.join(in_fields)))
+        out.flush()
 
-            else:
-                new_info = {
-                    'CMDB_AN': 'CMDB_AN={}'.format(cmdb_variant['allele_num']),
-                    'CMDB_AC': 'CMDB_AC={}'.format(cmdb_variant['allele_count']),
-                    'CMDB_AF': 'CMDB_AF={}'.format(cmdb_variant['allele_freq']),
-                    'CMDB_FILTER': 'CMDB_FILTER={}'.format(cmdb_variant['filter_status'])
-                }
-
-                info = in_fields[7]
-                if info != '.':
-                    for c in info.split(';'):
-                        k = c.split('=')[0]
-                        if k not in new_info:
-                            new_info[k] = c
-
-                info = ';'.join([new_info[k] for k in sorted(new_info.keys())])
-                if len(in_fields) > 8:
-
-                    sys.stdout.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
-                        chromosome, position, in_fields[2], ref, alt, in_fields[5], in_fields[6], info,
-                        '\t'.join(in_fields[8:]))
-                    )
-                else:
-                    sys.stdout.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
-                        chromosome, position, in_fields[2], ref, alt, in_fields[5], in_fields[6], info)
-                    )
     return
 
 
@@ -448,11 +840,15 @@ def main():
             pass
 
         elif args.command == 'annotate':
-            annotate(args.in_vcffile, filter=None)
+            annotate(args.in_vcffile, filter=None, threads=args.threads)
 
     except CMDBException as e:
         print (e)
 
+    except (HTTPError, HTTPException, socket.error) as e:
+        sys.stderr.write("[Error] Failed to query CMDB API: %s\n" % e)
+        sys.exit(1)
+
 
     elasped_time = datetime.now() -START_TIME
     sys.stderr.write("** Query CMDB done, %d seconds elapsed **\n" % (elasped_time.seconds))
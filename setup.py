@@ -46,9 +46,7 @@ if __name__ == "__main__":
           download_url=DOWNLOAD_URL,
           packages=find_packages(),
           include_package_data=True,
-          install_requires=[
-            "PyYAML>=5.1.2"
-          ],
+          install_requires=[],
 
           # scripts = ['cmdbtools/cmdbtools.py'],
           entry_points = {